@@ -1,32 +1,85 @@
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from cachetools import TTLCache
+from cachetools.keys import hashkey
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field
+import anyio.to_thread
 import datetime
 import ee
 import io
+import os
 import base64
 from PIL import Image
 import requests
-from typing import Optional
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # --- Initialize Earth Engine with Service Account ---
+# Done at import time so a preloading server (gunicorn --preload) authenticates
+# once in the master process and forks the initialized state into its workers;
+# gunicorn.conf.py drops the HTTP connections each worker inherits
 service_account = 'gemini-prod-api@gemini-prod-api-462407.iam.gserviceaccount.com'
 key_file = 'gemini-prod-api-462407-b5f5e844fb8f.json'
-credentials = ee.ServiceAccountCredentials(service_account, key_file)
+# The key JSON can be supplied through EE_SERVICE_ACCOUNT_KEY (e.g. a mounted
+# secret) so containers start without a key file on disk
+key_data = os.environ.get('EE_SERVICE_ACCOUNT_KEY')
+if key_data:
+    credentials = ee.ServiceAccountCredentials(service_account, key_data=key_data)
+else:
+    credentials = ee.ServiceAccountCredentials(service_account, key_file)
 ee.Initialize(credentials)
 
+# --- Shared HTTP session for thumbnail downloads ---
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_connections=50,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+))
+
+# Speculative downloads started before the stats are known use no retries, so
+# work abandoned on the 404/400 paths stays short
+_speculative_session = requests.Session()
+_speculative_session.mount("https://", HTTPAdapter(
+    pool_connections=50,
+    pool_maxsize=50,
+    max_retries=0
+))
+
 # --- FastAPI App ---
-app = FastAPI(title="Crop Stress Detection API", version="1.0.0")
+# Threads available for blocking Earth Engine and thumbnail work
+_MAX_THREADS = 200
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Earth Engine and thumbnail calls block, so allow more of them to run in the threadpool
+    anyio.to_thread.current_default_thread_limiter().total_tokens = _MAX_THREADS
+    yield
+
+app = FastAPI(title="Crop Stress Detection API", version="1.0.0", lifespan=lifespan,
+              default_response_class=ORJSONResponse)
 
 # --- Pydantic Models ---
+# Largest thumbnail side; a 4096x4096 RGB image is Earth Engine's 48 MiB request limit
+_MAX_IMAGE_DIMENSION = 4096
+
+# Thumbnails never legitimately exceed the largest requestable size, so bound decoding to it
+Image.MAX_IMAGE_PIXELS = _MAX_IMAGE_DIMENSION * _MAX_IMAGE_DIMENSION
+
 class LocationRequest(BaseModel):
-    latitude: float
-    longitude: float
-    buffer_distance: Optional[int] = 50  # meters
-    days_back: Optional[int] = 90
-    cloud_threshold: Optional[int] = 20
-    image_width: Optional[int] = 800
-    image_height: Optional[int] = 600
+    latitude: float = Field(ge=-90, le=90)
+    longitude: float = Field(ge=-180, le=180)
+    buffer_distance: int = Field(default=50, gt=0, le=10000)  # meters
+    days_back: int = Field(default=90, gt=0, le=3650)
+    cloud_threshold: int = Field(default=20, ge=0, le=100)
+    image_width: int = Field(default=800, gt=0, le=_MAX_IMAGE_DIMENSION)
+    image_height: int = Field(default=600, gt=0, le=_MAX_IMAGE_DIMENSION)
+    jpeg_quality: int = Field(default=85, ge=1, le=95)
 
 class NDVIResponse(BaseModel):
     status: str
@@ -35,39 +88,83 @@ class NDVIResponse(BaseModel):
     ndvi_stats: dict
     ndvi_image_base64: str  # Base64 encoded JPEG image
 
+# --- NDVI Health Classes ---
+# Upper bounds of each class; mean NDVI at or above the last bound is "Very Healthy"
+_NDVI_THRESHOLDS = (0.2, 0.4, 0.6, 0.8)
+_HEALTH_LABELS = (
+    "Severe Stress / Bare Soil",
+    "Stressed Vegetation",
+    "Moderate Health",
+    "Healthy",
+    "Very Healthy",
+)
+
 # --- Helper Functions ---
-def get_ndvi_data(lat: float, lon: float, buffer_distance: int, days_back: int, 
-                  cloud_threshold: int, image_width: int, image_height: int) -> tuple:
-    """Generate NDVI visualization and return image data and stats"""
+# Earth Engine results (thumbnail URL and stats) keyed by rounded location and params
+_ndvi_cache = TTLCache(maxsize=1024, ttl=3600)
+_ndvi_cache_lock = threading.Lock()
+
+# Renders and downloads thumbnails concurrently with the stats round-trip, one
+# slot per request thread. A render abandoned on the 404/400 paths keeps its
+# slot until its getThumbURL (and any download already under way) finishes
+_thumbnail_executor = ThreadPoolExecutor(max_workers=_MAX_THREADS)
+
+def _fetch_thumbnail(image_url: str, image_width: int, image_height: int,
+                     session: requests.Session = _session,
+                     timeout: float = 30) -> Image.Image:
+    """Download and decode an Earth Engine thumbnail"""
+    response = session.get(image_url, timeout=timeout)
+    response.raise_for_status()
+    img = Image.open(io.BytesIO(response.content))
+    # Let libjpeg downscale during decoding when the thumbnail is larger
+    img.draft("RGB", (image_width, image_height))
+    img.load()
+    return img
+
+def _render_thumbnail(ndvi: ee.Image, vis_params: dict, image_width: int,
+                      image_height: int, abandoned: threading.Event) -> tuple:
+    """Create the thumbnail URL and try a quick download, returning URL and image.
+
+    The image is None when the render was abandoned before downloading or the
+    no-retry download failed; the caller falls back to a regular download.
+    """
+    image_url = ndvi.getThumbURL(vis_params)
+    if abandoned.is_set():
+        return image_url, None
     try:
-        # Create geometry
-        point = ee.Geometry.Point([lon, lat])
-        aoi = point.buffer(buffer_distance).bounds()
-        
-        # Date range
-        end = datetime.date.today()
-        start = end - datetime.timedelta(days=days_back)
-        
-        # Sentinel-2 Collection
-        s2_collection = ee.ImageCollection("COPERNICUS/S2_HARMONIZED") \
-            .filterBounds(aoi) \
-            .filterDate(start.isoformat(), end.isoformat()) \
-            .filter(ee.Filter.lt("CLOUDY_PIXEL_PERCENTAGE", cloud_threshold))
-        
-        if s2_collection.size().getInfo() == 0:
-            raise HTTPException(status_code=404, detail="No suitable images found for the specified criteria")
-        
-        s2 = s2_collection.median().clip(aoi)
-        band_names = s2.bandNames().getInfo()
-        
-        if "B8" not in band_names or "B4" not in band_names:
-            raise HTTPException(status_code=400, detail="Required bands (B4 and B8) not found in the image")
-        
-        # Calculate NDVI
-        ndvi = s2.normalizedDifference(["B8", "B4"]).rename("NDVI")
-        
-        # Get NDVI statistics
-        ndvi_stats = ndvi.reduceRegion(
+        img = _fetch_thumbnail(image_url, image_width, image_height,
+                               session=_speculative_session, timeout=10)
+    except Exception:
+        img = None
+    return image_url, img
+
+def _compute_ndvi(lat: float, lon: float, buffer_distance: int, days_back: int,
+                  cloud_threshold: int, image_width: int, image_height: int) -> tuple:
+    """Run the Earth Engine side of the analysis and return thumbnail URL, stats and image"""
+    # Create geometry
+    point = ee.Geometry.Point([lon, lat])
+    aoi = point.buffer(buffer_distance).bounds()
+    
+    # Date range
+    end = datetime.date.today()
+    start = end - datetime.timedelta(days=days_back)
+    
+    # Sentinel-2 Collection
+    s2_collection = ee.ImageCollection("COPERNICUS/S2_HARMONIZED") \
+        .filterBounds(aoi) \
+        .filterDate(start.isoformat(), end.isoformat()) \
+        .filter(ee.Filter.lt("CLOUDY_PIXEL_PERCENTAGE", cloud_threshold))
+    
+    s2 = s2_collection.median().clip(aoi)
+    band_names = s2.bandNames()
+    
+    # Calculate NDVI
+    ndvi = s2.normalizedDifference(["B8", "B4"]).rename("NDVI")
+    
+    # NDVI statistics, only evaluated server-side when both bands are present
+    stats = ee.Algorithms.If(
+        band_names.containsAll(["B8", "B4"]),
+        ndvi.reduceRegion(
             reducer=ee.Reducer.mean().combine(
                 ee.Reducer.minMax().combine(
                     ee.Reducer.stdDev(), sharedInputs=True
@@ -76,38 +173,101 @@ def get_ndvi_data(lat: float, lon: float, buffer_distance: int, days_back: int,
             geometry=aoi,
             scale=10,
             maxPixels=1e9
-        ).getInfo()
+        ),
+        ee.Dictionary({})
+    )
+    
+    # Visualization parameters
+    vis_params = {
+        "min": 0.0,
+        "max": 1.0,
+        "palette": ["red", "orange", "yellow", "green", "darkgreen"],
+        "dimensions": f"{image_width}x{image_height}",
+        "format": "jpg"
+    }
+    
+    # Render and download the thumbnail while the stats are being computed.
+    # The render starts immediately, so on the 404/400 paths (or if getInfo
+    # fails) its getThumbURL call always runs and is wasted; abandoning it only
+    # skips the download if that has not started yet.
+    abandoned = threading.Event()
+    thumbnail_future = _thumbnail_executor.submit(
+        _render_thumbnail, ndvi, vis_params, image_width, image_height, abandoned
+    )
+    
+    try:
+        # Fetch collection size, band names and stats in a single round-trip
+        payload = ee.Dictionary({
+            "size": s2_collection.size(),
+            "bands": band_names,
+            "stats": stats
+        }).getInfo()
         
-        # Visualization parameters
-        vis_params = {
-            "min": 0.0,
-            "max": 1.0,
-            "palette": ["red", "orange", "yellow", "green", "darkgreen"],
-            "dimensions": f"{image_width}x{image_height}",
-            "format": "png"
-        }
+        if payload["size"] == 0:
+            raise HTTPException(status_code=404, detail="No suitable images found for the specified criteria")
         
-        # Get the image URL
-        image_url = ndvi.getThumbURL(vis_params)
+        if "B8" not in payload["bands"] or "B4" not in payload["bands"]:
+            raise HTTPException(status_code=400, detail="Required bands (B4 and B8) not found in the image")
         
-        # Download and convert image to base64
-        response = requests.get(image_url, timeout=30)
-        response.raise_for_status()
+        ndvi_stats = payload["stats"]
         
-        # Open image with PIL
-        img = Image.open(io.BytesIO(response.content))
+        # Wait for the thumbnail rendered alongside the stats
+        image_url, img = thumbnail_future.result()
+    finally:
+        abandoned.set()
+        thumbnail_future.cancel()
+    
+    if img is None:
+        # The quick speculative download failed; retry with the regular session
+        img = _fetch_thumbnail(image_url, image_width, image_height)
+    
+    return image_url, ndvi_stats, img
+
+def get_ndvi_data(lat: float, lon: float, buffer_distance: int, days_back: int, 
+                  cloud_threshold: int, image_width: int, image_height: int,
+                  jpeg_quality: int = 85) -> tuple:
+    """Generate NDVI visualization and return image data and stats"""
+    try:
+        key = hashkey(round(lat, 5), round(lon, 5), buffer_distance, days_back,
+                      cloud_threshold, image_width, image_height)
+        with _ndvi_cache_lock:
+            cached_result = _ndvi_cache.get(key)
+        
+        img = None
+        if cached_result is not None:
+            # Earth Engine work is cached; only the thumbnail needs downloading
+            image_url, ndvi_stats = cached_result
+            try:
+                img = _fetch_thumbnail(image_url, image_width, image_height)
+            except Exception:
+                # The cached thumbnail URL stopped working (expired or EE error);
+                # evict it and recompute below
+                with _ndvi_cache_lock:
+                    if _ndvi_cache.get(key) is cached_result:
+                        del _ndvi_cache[key]
+        
+        if img is None:
+            image_url, ndvi_stats, img = _compute_ndvi(*key)
+            with _ndvi_cache_lock:
+                _ndvi_cache[key] = (image_url, ndvi_stats)
         
-        # Convert to RGB if necessary (for JPEG)
+        # JPEG thumbnails from Earth Engine already decode as RGB, so this
+        # copy only happens for unexpected modes
         if img.mode != 'RGB':
             img = img.convert('RGB')
         
-        # Resize if needed
+        # Earth Engine renders at the requested dimensions; only resample
+        # if the thumbnail came back at a different size. The target size is
+        # client-supplied but capped at _MAX_IMAGE_DIMENSION by LocationRequest.
         if img.size != (image_width, image_height):
-            img = img.resize((image_width, image_height), Image.Resampling.LANCZOS)
+            # reducing_gap box-reduces large downscales before the Lanczos pass
+            img = img.resize((image_width, image_height), Image.Resampling.LANCZOS,
+                             reducing_gap=2.0)
         
         # Save as JPEG to BytesIO
         output = io.BytesIO()
-        img.save(output, format='JPEG', quality=95)
+        img.save(output, format='JPEG', quality=jpeg_quality, subsampling=2,
+                 optimize=False, progressive=False)
         output.seek(0)
         
         # Convert to base64
@@ -115,6 +275,8 @@ def get_ndvi_data(lat: float, lon: float, buffer_distance: int, days_back: int,
         
         return image_base64, ndvi_stats
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing NDVI: {str(e)}")
 
@@ -134,37 +296,22 @@ async def analyze_ndvi(request: LocationRequest):
     Returns JSON with base64-encoded image and NDVI stats.
     """
     try:
-        # Validate coordinates
-        if not (-90 <= request.latitude <= 90):
-            raise HTTPException(status_code=400, detail="Invalid latitude. Must be between -90 and 90")
-        if not (-180 <= request.longitude <= 180):
-            raise HTTPException(status_code=400, detail="Invalid longitude. Must be between -180 and 180")
-        
-        # Get NDVI image and stats
-        image_base64, ndvi_stats = get_ndvi_data(
+        # Get NDVI image and stats off the event loop
+        image_base64, ndvi_stats = await run_in_threadpool(
+            get_ndvi_data,
             request.latitude, 
             request.longitude, 
             request.buffer_distance,
             request.days_back,
             request.cloud_threshold,
             request.image_width,
-            request.image_height
+            request.image_height,
+            request.jpeg_quality
         )
         
         # Interpret NDVI values
         mean_ndvi = ndvi_stats.get('NDVI_mean', 0)
-        health_status = "Unknown"
-        
-        if mean_ndvi < 0.2:
-            health_status = "Severe Stress / Bare Soil"
-        elif mean_ndvi < 0.4:
-            health_status = "Stressed Vegetation"
-        elif mean_ndvi < 0.6:
-            health_status = "Moderate Health"
-        elif mean_ndvi < 0.8:
-            health_status = "Healthy"
-        else:
-            health_status = "Very Healthy"
+        health_status = _HEALTH_LABELS[bisect_right(_NDVI_THRESHOLDS, mean_ndvi)]
         
         return NDVIResponse(
             status="success",
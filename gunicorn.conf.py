@@ -0,0 +1,14 @@
+# Gunicorn settings, loaded automatically when gunicorn starts from this directory
+import ee
+
+
+def post_fork(server, worker):
+    """Drop Earth Engine HTTP connections inherited from the master process.
+
+    With --preload, ee.Initialize runs in the master and leaves a keep-alive TLS
+    connection in ee.data's requests session. Every forked worker would share
+    that socket, so each worker closes its copy and opens its own connections.
+    """
+    session = getattr(ee.data, "_requests_session", None)
+    if session is not None:
+        session.close()